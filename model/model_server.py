@@ -1,8 +1,12 @@
+import asyncio
 import logging
+import queue
 import sys
+import threading
+import time
 from typing import List
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import uvicorn
@@ -14,6 +18,8 @@ from resnet import ResNet
 
 PORT = 8000
 DIM = 20
+MAX_BATCH = 64
+MAX_WAIT_MS = 8
 
 app = FastAPI()
 origins = [
@@ -31,6 +37,121 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 model = ResNet(10, 256)
 
 
+def padded_size(num_requests):
+    """Round up to a power of two so the compiled model only sees a few batch shapes"""
+    return 1 << (num_requests - 1).bit_length()
+
+
+def resolve(future, result):
+    """Hand a result or error back to a request that is still waiting"""
+    if future.cancelled():
+        return
+    if isinstance(result, Exception):
+        future.set_exception(result)
+    else:
+        future.set_result(result)
+
+
+class BatchScheduler:
+    """Combines concurrent requests into batches for the model
+
+    Each request is put on a queue and awaits a future for its result, so no
+    threads are tied up while requests wait to be batched. A single worker
+    thread takes requests off the queue until it has MAX_BATCH of them or
+    MAX_WAIT_MS has passed, runs them through the model in one forward pass,
+    and hands each request back its own policy and values. Batches are padded
+    with empty boards to a power of two to avoid recompiling the model, and
+    the worker compiles every padded size before it takes any requests.
+    """
+
+    def __init__(self, model, device):
+        self.model = model
+        self.device = device
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.ready = threading.Event()
+        self.warm_up_error = None
+
+    def start(self):
+        """Start the worker and wait until it has compiled the model"""
+        self.worker.start()
+        self.ready.wait()
+        if self.warm_up_error is not None:
+            raise self.warm_up_error
+
+    def warm_up(self):
+        """Compile the model for every padded batch size
+
+        CUDA graphs recorded by the compiled model belong to the thread that
+        ran it, so this runs on the worker thread that serves requests.
+        """
+        size = 1
+        while size <= padded_size(MAX_BATCH):
+            self.forward(torch.zeros(size, 5, DIM, DIM, dtype=torch.float32))
+            size *= 2
+
+    def forward(self, boards):
+        """Run a padded batch of boards through the model"""
+        boards = boards.to(self.device, memory_format=torch.channels_last)
+        use_bf16 = self.device.type == "cuda"
+        with torch.inference_mode(), torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=use_bf16):
+            return self.model(boards)
+
+    async def predict(self, boards):
+        """Queue up a single board state and wait for the model's output"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.requests.put((boards, loop, future))
+        return await future
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + MAX_WAIT_MS / 1000
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def run(self):
+        try:
+            self.warm_up()
+        except Exception as e:
+            logging.exception("Failed to compile the model")
+            self.warm_up_error = e
+        self.ready.set()
+        if self.warm_up_error is not None:
+            return
+
+        while True:
+            batch = self.next_batch()
+            try:
+                boards = torch.zeros(padded_size(len(batch)), 5, DIM, DIM, dtype=torch.float32)
+                torch.stack([boards for boards, _, _ in batch], out=boards[:len(batch)])
+                policies, values = self.forward(boards)
+                policies = policies[:len(batch)].cpu().tolist()
+                values = values[:len(batch)].cpu().tolist()
+                results = list(zip(policies, values))
+            except Exception as e:
+                logging.exception("Failed to process batch")
+                results = [e] * len(batch)
+
+            # A request whose event loop has gone away must not stop the worker
+            for (_, loop, future), result in zip(batch, results):
+                try:
+                    loop.call_soon_threadsafe(resolve, future, result)
+                except Exception:
+                    logging.exception("Failed to return result to request")
+
+
+scheduler = BatchScheduler(torch.compile(model, mode="reduce-overhead", dynamic=False), device)
+
+
 class TensorData(BaseModel):
     player: int
     data: List[List[List[bool]]]
@@ -38,19 +159,23 @@ class TensorData(BaseModel):
 @app.post("/process_request")
 async def process_tensor(request: TensorData):
 
-    # Convert the list of numbers to a numpy array
+    # Convert the list of numbers to a tensor, rejecting bad shapes before they
+    # can share a batch with other requests
     logging.debug(f"Received request: {request}")
-    boards = torch.tensor(request.data, dtype=torch.float32).to(device)
+    try:
+        boards = torch.from_numpy(np.asarray(request.data, dtype=np.float32))
+    except ValueError:
+        boards = None
+    if boards is None or boards.shape != (5, DIM, DIM):
+        raise HTTPException(status_code=422, detail=f"Expected boards with shape (5, {DIM}, {DIM})")
 
-    # Query the model
-    with torch.no_grad():
-        batch = boards.unsqueeze(0)
-        policy, values = model(batch)
+    # Query the model along with any other requests that come in
+    policy, values = await scheduler.predict(boards)
 
     # Format response
     result = {
-        "policy": policy[0].tolist(),
-        "values": values[0].tolist(),
+        "policy": policy,
+        "values": values,
         "status": 200,
     }
     logging.debug(f"Returning response: {result}")
@@ -61,6 +186,9 @@ if __name__ == "__main__":
 
     path = sys.argv[1]
     model.load_state_dict(torch.load(path, weights_only=True, map_location=device))
+    model.to(device, memory_format=torch.channels_last)
+    model.eval()
     logging.info(f"Loaded model from {path}")
+    scheduler.start()
 
     uvicorn.run(app, host="0.0.0.0", port=PORT)
@@ -5,10 +5,13 @@ import argparse
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from queue import Empty
 
 import wandb
 from tqdm import trange, tqdm
+from numba import njit, prange
+import numpy as np
 import torch
 from torchrl.data import ReplayBuffer, LazyTensorStorage
 from tensordict import tensorclass
@@ -17,8 +20,14 @@ from blokus_self_play import play_training_game
 from resnet import ResNet
 
 DIM = 20
+MAX_MOVES = DIM * DIM  # Each move in a game history fills one empty tile
 MODEL_PATH = "./weights"
 
+# Where each tile ends up when the board is rotated 90 degrees k times
+ROTATIONS = np.stack([
+    np.argsort(np.rot90(np.arange(DIM * DIM).reshape(DIM, DIM), k).ravel()) for k in range(4)
+]).astype(np.int32)
+
 @tensorclass
 class Data:
     states: torch.Tensor
@@ -37,7 +46,14 @@ def empty_queue(queue, device):
         except Empty as e:
             break
 
-    return ids, torch.tensor(items, dtype=torch.float32).view(-1, 5, DIM, DIM).to(device)
+    # Board states are sent to the device as bools and only then converted to floats
+    boards = torch.from_numpy(np.array(items, dtype=np.bool_)).view(-1, 5, DIM, DIM)
+    return ids, boards.to(device).float()
+
+
+def autocast(device):
+    """Run the model in bfloat16 on the GPU, does nothing on the CPU"""
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=device.type == "cuda")
 
 
 def handle_inference_batch(model, device, inference_queue, pipes_to_workers):
@@ -56,7 +72,7 @@ def handle_inference_batch(model, device, inference_queue, pipes_to_workers):
         return 0
 
     # Query the model for the batch of inputs
-    with torch.no_grad():
+    with torch.inference_mode(), autocast(device):
         policies, values = model(batch)
 
     # Send the outputs to the appropriate worker
@@ -67,79 +83,149 @@ def handle_inference_batch(model, device, inference_queue, pipes_to_workers):
     return num_requests
 
 
-def save(game, buffer: ReplayBuffer,):
-    """Save the game data to the replay buffer"""
+def decode_game(history, policies):
+    """Convert the game data from self-play into flat numpy arrays
 
-    # Allocate space for the data
-    history, policies, values = game
-    num_moves = len(history)
-    logging.debug(f"Saving game with {num_moves} moves to the replay buffer")
+    The policies are ragged, so they are flattened into one array of actions
+    and one of probabilities, with offsets marking where each move starts.
+    The kernel that uses these arrays does not check bounds, so they are
+    validated here.
+    """
+
+    assert len(policies) == len(history) <= MAX_MOVES, "Expected one policy for each move"
+    moves = np.array(history, dtype=np.int32).reshape(-1, 2)
+    elements = np.array([element for policy in policies for element in policy], dtype=np.float32).reshape(-1, 2)
+    offsets = np.zeros(len(policies) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(policy) for policy in policies])
+
+    players, tiles = moves[:, 0], moves[:, 1]
+    actions, probs = elements[:, 0].astype(np.int32), elements[:, 1]
+    assert np.all((players >= 0) & (players < 4)), "Players must be between 0 and 3"
+    assert np.all((tiles >= 0) & (tiles < DIM * DIM)), "Tiles must be on the board"
+    assert np.all((actions >= 0) & (actions < DIM * DIM)), "Actions must be on the board"
 
-    state_data = torch.zeros(num_moves, 5, DIM, DIM, dtype=torch.float32)
-    policy_data = torch.zeros(num_moves, DIM * DIM, dtype=torch.float32)
-    value_data = torch.tensor(values, dtype=torch.float32).repeat(num_moves, 1)
+    return players, tiles, actions, probs, offsets
 
-    # For each move from this game, update the state and policy
-    # new_state holds running game state
-    new_state = torch.zeros(5, DIM, DIM, dtype=torch.float32)
-    for i, (move, policy) in enumerate(zip(history, policies)):
 
-        # Shift the state to the correct player's perspective
-        player, tile = move
-        state_data[i] = torch.cat((new_state[player:4], new_state[:player], new_state[4].unsqueeze(0)), dim=0)
+@njit(cache=True, parallel=True)
+def fill_state_policy(players, tiles, actions, probs, offsets, states_out, policies_out):
+    """Write the state and policy for each move into the preallocated buffers
 
-        # Update the policy for this move
-        for element in policy:
-            action, prob = element
-            policy_data[i, action] = prob
+    States are shifted and rotated to the perspective of the player making the
+    move, and the policy is rotated to match. Each perspective keeps its own
+    running board, so the history before a move is copied in rather than
+    replayed for every move. Boards are indexed by tile, so states_out is
+    expected with the board flattened to DIM * DIM.
+    """
 
-            # Update which squares are legal on this move
-            row, col = action // DIM, action % DIM
-            state_data[i, 4, row, col] = 1
+    # Place the moves on the board before each player's turns
+    for player in prange(4):
+        rotation = ROTATIONS[player]
+        board = np.zeros((4, DIM * DIM), dtype=states_out.dtype)
+        for i in range(players.shape[0]):
+            if players[i] == player:
+                states_out[i, :4] = board
+            tile = rotation[tiles[i]]
+            board[(players[i] - player + 4) % 4, tile] = 1
+
+    # Update the policy and which squares are legal on each move
+    for i in prange(players.shape[0]):
+        rotation = ROTATIONS[players[i]]
+        for k in range(offsets[i], offsets[i + 1]):
+            tile = rotation[actions[k]]
+            states_out[i, 4, tile] = 1
+            policies_out[i, tile] = probs[k]
+
+
+def save(game, buffer: ReplayBuffer, state_scratch, policy_scratch):
+    """Save the game data to the replay buffer
+
+    The data is built in scratch arrays of MAX_MOVES rows that are reused for
+    every game, and the scores are a broadcast view of the final values, since
+    extending the buffer copies the data straight into its storage.
+    """
 
-        # Rotate state and policy so perspective is the same
-        state_data[i] = torch.rot90(state_data[i], k=player, dims=(1, 2))
-        policy_data[i] = torch.rot90(policy_data[i].reshape(DIM, DIM), k=player).reshape(-1)
+    # Clear space for the data
+    history, policies, values = game
+    num_moves = len(history)
+    logging.debug(f"Saving game with {num_moves} moves to the replay buffer")
 
-        # Make the move that was made
-        row, col = tile // DIM, tile % DIM
-        new_state[player, row, col] = 1
+    state_data = state_scratch[:num_moves]
+    policy_data = policy_scratch[:num_moves]
+    state_data.fill(0)
+    policy_data.fill(0)
+    value_data = torch.tensor(values, dtype=torch.float32).expand(num_moves, -1)
 
-        # if  i < 20:
-        #     print(f"Player {player}")
-        #     print(f"State: {state_data[i]}")
-        #     print(f"Policy: {policy_data[i]}")
+    # Fill in the state and policy for each move from this game
+    players, tiles, actions, probs, offsets = decode_game(history, policies)
+    flat_states = state_data.reshape(num_moves, 5, DIM * DIM)
+    fill_state_policy(players, tiles, actions, probs, offsets, flat_states, policy_data)
 
     data = Data(
-        states = state_data,
-        policies = policy_data,
+        states = torch.from_numpy(state_data),
+        policies = torch.from_numpy(policy_data),
         scores = value_data,
         batch_size = [num_moves]
     )
     buffer.extend(data)
 
 
-def train(step, model, buffer, optimizer, policy_loss, value_loss, device, testing):
-    """Train the model on a batch of data from the replay buffer"""
+def sample_batch(buffer, pin_memory):
+    """Sample a batch from the replay buffer
+
+    Pinning the batch lets it be copied to the GPU without blocking.
+    """
 
-    # Get a batch of data from the replay buffer
     batch = buffer.sample()
-    inputs = batch.get("states").to(device)
-    policies = batch.get("policies").to(device)
-    values = batch.get("scores").to(device)
+    if pin_memory:
+        batch = batch.pin_memory()
+    return batch
+
+
+def policy_cross_entropy(policy, target):
+    """Cross entropy between the model's policy and the MCTS policy
+
+    Same as nn.CrossEntropyLoss with probability targets, written out so it
+    can be fused with the rest of the compiled training step.
+    """
+    return -(target * torch.log_softmax(policy, dim=-1)).sum(dim=-1).mean()
+
+
+def train_step(model, optimizer, policy_loss, value_loss, inputs, policies, values):
+    """Run one optimization step on a batch that is already on the device"""
 
-    # Train the model
     optimizer.zero_grad()
-    policy, value = model(inputs)
-    policy_loss = policy_loss(policy, policies)
-    value_loss = value_loss(value, values)
-    loss = policy_loss + value_loss
+    with autocast(inputs.device):
+        policy, value = model(inputs)
+        policy_loss = policy_loss(policy, policies)
+        value_loss = value_loss(value, values)
+        loss = policy_loss + value_loss
     loss.backward()
     optimizer.step()
 
-    # Store training statistics
-    if not testing:
-        wandb.log({"policy_loss": policy_loss, "value_loss": value_loss}, step=step)
+    return loss, policy_loss, value_loss
+
+
+# Training batches always have the same shape, so the whole step is compiled
+compiled_train_step = torch.compile(train_step, mode="reduce-overhead")
+
+
+def train(model, batch, optimizer, policy_loss, value_loss, device):
+    """Train the model on a batch of data from the replay buffer
+
+    Returns the policy and value losses for this step, left on the device
+    so the statistics can be fetched all at once when the round is done.
+    """
+
+    # Move the batch to the device, states are stored as bytes to save memory
+    inputs = batch.get("states").to(device, non_blocking=True).float()
+    policies = batch.get("policies").to(device, non_blocking=True)
+    values = batch.get("scores").to(device, non_blocking=True)
+
+    # Train the model
+    _, policy_loss, value_loss = compiled_train_step(model, optimizer, policy_loss, value_loss, inputs, policies, values)
+
+    return torch.stack([policy_loss, value_loss]).detach()
 
 
 def main():
@@ -171,7 +257,7 @@ def main():
     # Create the model, optimizer, and loss
     model = ResNet(config.nn_depth, config.nn_width, config.custom_filters).to(device)
     optimizer = torch.optim.Adam(model.parameters(), lr=config.learning_rate)
-    policy_loss = torch.nn.CrossEntropyLoss().to(device)
+    policy_loss = policy_cross_entropy
     value_loss = torch.nn.MSELoss().to(device)
 
     # Configure Weights and Biases
@@ -186,19 +272,29 @@ def main():
         batch_size=config.batch_size
     )
 
+    # Reusable space for building each game's data before it goes in the buffer
+    state_scratch = np.zeros((MAX_MOVES, 5, DIM, DIM), dtype=np.uint8)
+    policy_scratch = np.zeros((MAX_MOVES, DIM * DIM), dtype=np.float32)
+
+    # Create the queues and pipes once, they are empty again after every round
+    manager = mp.Manager()
+    request_queue = manager.Queue(maxsize=config.cpus * config.games_per_cpu)
+    pipes_to_model = []
+    pipes_to_workers = []
+    for i in range(config.games_per_round()):
+        a, b = mp.Pipe()
+        pipes_to_model.append(a)
+        pipes_to_workers.append(b)
+
     # Train the model
+    executor = ThreadPoolExecutor(max_workers=1)
+    save_future = None
     global_step = 0
     for round in trange(config.training_rounds):
 
-        # Create the queues and pipes
-        manager = mp.Manager()
-        request_queue = manager.Queue(maxsize=config.cpus * config.games_per_cpu)
-        pipes_to_model = []
-        pipes_to_workers = []
-        for i in range(config.games_per_round()):
-            a, b = mp.Pipe()
-            pipes_to_model.append(a)
-            pipes_to_workers.append(b)
+        # Raise any error from saving the last round's weights before starting self-play
+        if save_future is not None:
+            save_future.result()
 
         # Generate spawn asynchronous self-play processes
         with mp.get_context("spawn").Pool(config.cpus) as pool:
@@ -217,15 +313,36 @@ def main():
 
             # Save the game data to the replay buffer
             for game in game_data.get():
-                save(game, buffer)
+                save(game, buffer, state_scratch, policy_scratch)
 
-        # Train the model
+        # Train the model, sampling the next batch while the current one trains
+        losses = []
+        pin_memory = device.type == "cuda"
+        next_batch = executor.submit(sample_batch, buffer, pin_memory)
         for step in trange(config.training_steps, desc=f"Training round {round}", leave=False):
-            train(global_step, model, buffer, optimizer, policy_loss, value_loss, device, args.test)
-            global_step += 1
-        torch.save(model.state_dict(), f"{MODEL_PATH}/latest_model.pt")
+            batch = next_batch.result()
+            if step + 1 < config.training_steps:
+                next_batch = executor.submit(sample_batch, buffer, pin_memory)
+            losses.append(train(model, batch, optimizer, policy_loss, value_loss, device))
+
+        # Write the weights to disk in the background, from a copy since
+        # self-play in the next round still updates the batch norm statistics
+        state_dict = model.state_dict()
+        for key in state_dict:
+            state_dict[key] = state_dict[key].detach().to("cpu", copy=True)
+        save_future = executor.submit(torch.save, state_dict, f"{MODEL_PATH}/latest_model.pt")
+
+        # Store training statistics
+        if not args.test:
+            for i, (policy, value) in enumerate(torch.stack(losses).tolist()):
+                wandb.log({"policy_loss": policy, "value_loss": value}, step=global_step + i)
+        global_step += config.training_steps
 
     # Clean up
+    if save_future is not None:
+        save_future.result()
+    executor.shutdown()
+    manager.shutdown()
     logging.info("Training complete")
 
 
@@ -21,16 +21,25 @@ pub struct Config {
     exploration_fraction: f32,
 }
 
-/// Rotates the policy 90 degrees to the right
-fn rotate_policy(state: Vec<f32>) -> Vec<f32> {
+/// Rotates the policy 90 degrees to the right k times in a single pass
+fn rotate_policy(state: Vec<f32>, k: usize) -> Vec<f32> {
+    if k % 4 == 0 {
+        return state;
+    }
+
     let mut rotated = vec![0.0; BOARD_SIZE];
     for i in 0..D {
         for j in 0..D {
-            rotated[j * D + (D - 1 - i)] = state[i * D + j];
+            let (row, col) = match k % 4 {
+                1 => (j, D - 1 - i),
+                2 => (D - 1 - i, D - 1 - j),
+                _ => (D - 1 - j, i),
+            };
+            rotated[row * D + col] = state[i * D + j];
         }
     }
 
-    rotated.to_vec()
+    rotated
 }
 
 /// Evaluate and Expand the Node
@@ -58,9 +67,7 @@ fn evaluate(
     let current_player = game.current_player();
 
     // Rotate the policy so they are in order
-    for _ in 0..(current_player) {
-        policy = rotate_policy(policy);
-    }
+    policy = rotate_policy(policy, current_player);
     value.rotate_right(current_player);
 
     // Normalize policy for node priors, filter out illegal moves